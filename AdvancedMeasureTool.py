@@ -1,4 +1,5 @@
-from qgis.PyQt.QtCore import Qt, QVariant
+from qgis.PyQt import sip
+from qgis.PyQt.QtCore import Qt, QVariant, QElapsedTimer, QTimer
 from qgis.PyQt.QtGui import QIcon, QColor
 from qgis.PyQt.QtWidgets import QAction, QMessageBox
 
@@ -6,21 +7,57 @@ from qgis.core import (
     QgsProject,
     QgsGeometry,
     QgsFeature,
+    QgsFeatureSink,
     QgsVectorLayer,
     QgsField,
+    QgsFields,
     QgsWkbTypes,
     QgsDistanceArea,
     QgsLineSymbol,
     QgsPointXY,
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
+    QgsUnitTypes,
     Qgis
 )
 
 from qgis.gui import QgsMapTool, QgsRubberBand, QgsMapCanvas
 
+import math
 import os
+import struct
 from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+# metres → nautical miles
+_INV_NM = 1.0 / 1852.0
+
+# PROJ acronyms of low-distortion conformal projections (UTM and other transverse Mercator zones)
+# where the grid distance matches the ellipsoidal one closely enough for the live preview
+_PLANAR_PREVIEW_PROJECTIONS = ('utm', 'tmerc', 'etmerc')
+
+# little-endian WKB of a 2-point LineString: byte order, geometry type, point count, x1, y1, x2, y2
+_SEGMENT_WKB = struct.Struct('<BII4d')
+
+
+@lru_cache(maxsize=32)
+def _xform(src_authid):
+    """Transform from the CRS src_authid to WGS84, reused across measurements.
+    Cleared when the project's transform context changes."""
+    return QgsCoordinateTransform(QgsCoordinateReferenceSystem(src_authid),
+                                  QgsCoordinateReferenceSystem("EPSG:4326"),
+                                  QgsProject.instance())
+
+
+def _haversine_m(lon1, lat1, lon2, lat2, radius):
+    """Great-circle distance in metres between two lon/lat points (degrees) on a sphere of the given radius."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (math.sin((phi2 - phi1) * 0.5) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) * 0.5) ** 2)
+    return 2.0 * radius * math.asin(math.sqrt(a))
 
 class AdvancedMeasureTool:
 
@@ -41,7 +78,12 @@ class AdvancedMeasureTool:
         self.measure_action.triggered.connect(self.toggle_tool)
         self.toolbar.addAction(self.measure_action)
 
+        # cached WGS84 transforms depend on the project's transform context
+        QgsProject.instance().transformContextChanged.connect(_xform.cache_clear)
+
     def unload(self):
+        QgsProject.instance().transformContextChanged.disconnect(_xform.cache_clear)
+        _xform.cache_clear()
         if self.toolbar:
             try:
                 self.iface.mainWindow().removeToolBar(self.toolbar)
@@ -77,11 +119,12 @@ class AdvancedMeasureTool:
             self.canvas = canvas
             self.action = action
 
-            # data storage (IN MEMORY ONLY)
-            # each row: { 'Line_ID': int, 'P1x', 'P1y', 'P2x', 'P2y', 'length_m', 'length_nm', 'cum_length_m', 'cum_length_nm' }
-            self.table_rows = []
+            # data storage (IN MEMORY ONLY), one array per column; row i is segment Line_ID i + 1
+            # values are stored unrounded, rounding happens once in finish_measurement
+            # P1/P2: (x, y) of segment start/end, length_m: segment length; grown by doubling
+            self._allocate_rows(64)
             self.n = 0 # index of current segment (starts at 0 for first segment)
-            self.var_cum_length_m = 0.0
+            self._cum_at_last_vertex = 0.0 # total length up to the last clicked point (live preview)
 
             # measurement state
             self.last_point = None
@@ -96,14 +139,50 @@ class AdvancedMeasureTool:
             self.main_rb.setWidth(3)
             self.main_rb.setColor(Qt.red)
 
-            # distance calculator set to project CRS
+            # live preview message, updated in place instead of re-pushed on every move
+            self._msg_item = None
+            self._msg_shown = None
+            self._msg_pending = None # latest (length_m, cum_m) not shown yet
+            self._msg_timer = QElapsedTimer()
+            self._msg_refresh = QTimer(self) # trailing update for throttled moves
+            self._msg_refresh.setSingleShot(True)
+            self._msg_refresh.timeout.connect(self._flush_preview_message)
+
+            # distance calculator set to project CRS, kept in sync while the tool is active
             self.da = QgsDistanceArea()
-            self.da.setSourceCrs(canvas.mapSettings().destinationCrs(),
-                                 QgsProject.instance().transformContext())
-            self.da.setEllipsoid(QgsProject.instance().ellipsoid() or 'WGS84')
+            self._update_distance_area()
+
+        def _allocate_rows(self, capacity):
+            self.P1 = np.empty((capacity, 2))
+            self.P2 = np.empty((capacity, 2))
+            self.length_m = np.empty(capacity)
 
-            # Line_ID counter for points (counts points starting from 1)
-            self.point_id_counter = 0
+        def _grow_rows(self):
+            """Double the row capacity, keeping the rows stored so far."""
+            P1, P2, length_m = self.P1, self.P2, self.length_m
+            self._allocate_rows(2 * len(length_m))
+            self.P1[:len(P1)] = P1
+            self.P2[:len(P2)] = P2
+            self.length_m[:len(length_m)] = length_m
+
+        ###################################################################
+        # ACTIVATE / DEACTIVATE — CRS, ellipsoid and transform context sync
+        ###################################################################
+        def activate(self):
+            super().activate()
+            # changes made while the tool was inactive were not tracked
+            self._update_distance_area()
+            self.canvas.destinationCrsChanged.connect(self._update_distance_area)
+            QgsProject.instance().ellipsoidChanged.connect(self._update_distance_area)
+            QgsProject.instance().transformContextChanged.connect(self._update_distance_area)
+
+        def deactivate(self):
+            # the preview item has no timeout, don't leave it behind for the next map tool
+            self._clear_preview_message()
+            self.canvas.destinationCrsChanged.disconnect(self._update_distance_area)
+            QgsProject.instance().ellipsoidChanged.disconnect(self._update_distance_area)
+            QgsProject.instance().transformContextChanged.disconnect(self._update_distance_area)
+            super().deactivate()
 
         ###################################################################
         # LEFT CLICK — build table in memory only
@@ -118,50 +197,29 @@ class AdvancedMeasureTool:
             if self.click_count == 1:
                 self.start_new_measurement()
                 self.last_point = pt
-                self.point_id_counter += 1
-                
+
                 # First row only stores P1
-                self.table_rows.append({
-                    'Line_ID': self.point_id_counter,
-                    'P1x': round(pt.x(), 6),
-                    'P1y': round(pt.y(), 6),
-                    'P2x': None,
-                    'P2y': None,
-                    'length_m': None,
-                    'length_nm': None,
-                    'cum_length_m': None,
-                    'cum_length_nm': None
-                })
+                self.P1[0] = pt.x(), pt.y()
 
             else:
                 # fill P2 of previous row
-                self.table_rows[self.n]['P2x'] = round(pt.x(), 6)
-                self.table_rows[self.n]['P2y'] = round(pt.y(), 6)
+                self.P2[self.n] = pt.x(), pt.y()
 
                 # compute segment
                 self.calculate_segment(self.n)
 
-                # draw segment
-                self.main_rb.addPoint(self.last_point)
+                # draw segment; only the second addPoint updates (repaints) the rubber band
+                self.main_rb.addPoint(self.last_point, False)
                 self.main_rb.addPoint(pt)
 
                 # next row begins at this point
                 self.last_point = pt
-                self.point_id_counter += 1
                 self.n += 1
+                if self.n == len(self.length_m):
+                    self._grow_rows()
 
                 # new row for next segment
-                self.table_rows.append({
-                    'Line_ID': self.point_id_counter,
-                    'P1x': round(pt.x(), 6),
-                    'P1y': round(pt.y(), 6),
-                    'P2x': None,
-                    'P2y': None,
-                    'length_m': None,
-                    'length_nm': None,
-                    'cum_length_m': None,
-                    'cum_length_nm': None
-                })
+                self.P1[self.n] = pt.x(), pt.y()
 
 
         ###################################################################
@@ -173,27 +231,58 @@ class AdvancedMeasureTool:
 
             cur_pt = self.toMapCoordinates(event.pos())
 
-            # update temp rubber band
-            self.temp_rb.reset(QgsWkbTypes.LineGeometry)
-            self.temp_rb.addPoint(self.last_point)
-            self.temp_rb.addPoint(cur_pt)
+            # update temp rubber band in one step
+            self.temp_rb.setToGeometry(QgsGeometry.fromPolylineXY([self.last_point, cur_pt]), None)
 
-            # compute temporary length
-            geom = QgsGeometry.fromPolylineXY([self.last_point, cur_pt])
-            length_m = self.da.measureLength(geom)
-            length_nm = length_m / 1852.0
-            cum_m = self.var_cum_length_m + length_m
-            cum_nm = cum_m / 1852.0
+            # compute temporary length (planar / spherical shortcuts, preview only)
+            if self._is_planar_meters:
+                length_m = math.hypot(cur_pt.x() - self.last_point.x(), cur_pt.y() - self.last_point.y())
+            elif self._is_lonlat:
+                length_m = _haversine_m(self.last_point.x(), self.last_point.y(),
+                                        cur_pt.x(), cur_pt.y(), self._sphere_radius)
+            else:
+                length_m = self.da.measureLine(self.last_point, cur_pt)
+            cum_m = self._cum_at_last_vertex + length_m
+
+            self._show_preview_message(length_m, cum_m)
+
+        def _show_preview_message(self, length_m, cum_m):
+            """Update the live message bar item, at most ~30 times per second and only on visible changes."""
+            self._msg_pending = (length_m, cum_m)
+            if self._msg_timer.isValid() and self._msg_timer.elapsed() < 33:
+                # throttled: show the latest value once the interval has passed
+                if not self._msg_refresh.isActive():
+                    self._msg_refresh.start(max(0, 33 - self._msg_timer.elapsed()))
+                return
+            self._flush_preview_message()
 
-            # Clear old messages
-            self.iface.messageBar().clearWidgets()
+        def _flush_preview_message(self):
+            if self._msg_pending is None:
+                return
+            length_m, cum_m = self._msg_pending
+            self._msg_pending = None
+            item_alive = self._msg_item is not None and not sip.isdeleted(self._msg_item)
+            shown = (round(length_m, 1), round(cum_m, 1))
+            if item_alive and shown == self._msg_shown:
+                return
+            self._msg_timer.start()
+            self._msg_shown = shown
+
+            text = f"Segment: {length_m:.1f} m ({length_m * _INV_NM:.2f} nm) | Total: {cum_m:.1f} m ({cum_m * _INV_NM:.2f} nm)"
+            if item_alive:
+                self._msg_item.setText(text)
+            else:
+                # stays until the measurement is finished or cancelled, or the tool is deactivated
+                self._msg_item = self.iface.messageBar().createMessage("Measure", text)
+                self.iface.messageBar().pushWidget(self._msg_item, Qgis.Info, 0)
 
-            self.iface.messageBar().pushMessage(
-                "Measure",
-                f"Segment: {length_m:.1f} m ({length_nm:.2f} nm) | Total: {cum_m:.1f} m ({cum_nm:.2f} nm)",
-                level=Qgis.Info,
-                duration=5
-            )
+        def _clear_preview_message(self):
+            self._msg_refresh.stop()
+            self._msg_pending = None
+            if self._msg_item is not None and not sip.isdeleted(self._msg_item):
+                self.iface.messageBar().popWidget(self._msg_item)
+            self._msg_item = None
+            self._msg_shown = None
 
 
         ###################################################################
@@ -214,72 +303,94 @@ class AdvancedMeasureTool:
         # CREATE FINAL LAYER ON DOUBLE CLICK
         ###################################################################
         def finish_measurement(self):
-            self.is_measuring = False
-
-            # filter out incomplete last row
-            final_rows = [r for r in self.table_rows if r['P2x'] is not None]
-            if len(final_rows) == 0:
+            # only the first n rows are complete; row n holds P1 of the unfinished segment
+            n = self.n
+            if n == 0:
+                self._reset_state()
                 return
 
-            # create memory layer
-            crs = self.canvas.mapSettings().destinationCrs().authid()
-            layer = QgsVectorLayer(f"LineString?crs={crs}", f"Measurement_{datetime.now().strftime('%Y%m%d_%H%M%S')}", "memory")
-            pr = layer.dataProvider()
+            # derived columns, computed for all segments at once
+            length_m = self.length_m[:n]
+            cum_length_m = np.cumsum(length_m)
+            line_ids = np.arange(1, n + 1).tolist()
+            length_nm = np.round(length_m * _INV_NM, 2).tolist()
+            cum_length_nm = np.round(cum_length_m * _INV_NM, 2).tolist()
+            length_m = np.round(length_m, 1).tolist()
+            cum_length_m = np.round(cum_length_m, 1).tolist()
 
-            # add fields
-            pr.addAttributes([
-                QgsField("Line_ID", QVariant.Int),
-                QgsField("Start", QVariant.String),
-                QgsField("Stop", QVariant.String),
-                QgsField("length_m", QVariant.Double),
-                QgsField("length_nm", QVariant.Double),
-                QgsField("cum_length_m", QVariant.Double),
-                QgsField("cum_length_nm", QVariant.Double)
-            ])
+            # project CRS, looked up once
+            crs = self.canvas.mapSettings().destinationCrs()
+            crs_authid = crs.authid()
+            is_geographic = crs.isGeographic()
+
+            # fields, built up front and shared by the provider and the features
+            fields = QgsFields()
+            fields.append(QgsField("Line_ID", QVariant.Int))
+            fields.append(QgsField("Start", QVariant.String))
+            fields.append(QgsField("Stop", QVariant.String))
+            fields.append(QgsField("length_m", QVariant.Double))
+            fields.append(QgsField("length_nm", QVariant.Double))
+            fields.append(QgsField("cum_length_m", QVariant.Double))
+            fields.append(QgsField("cum_length_nm", QVariant.Double))
+
+            # create memory layer; CRS set from the object (also covers custom CRSes without authid)
+            layer = QgsVectorLayer("LineString", f"Measurement_{datetime.now().strftime('%Y%m%d_%H%M%S')}", "memory")
+            layer.setCrs(crs)
+            pr = layer.dataProvider()
+            pr.addAttributes(fields.toList())
+            # the layer only picks up provider-side attribute changes through updateFields()
             layer.updateFields()
 
-            # add features
-            feats = []
-            crs = self.canvas.mapSettings().destinationCrs()
-            wgs84_crs = QgsCoordinateReferenceSystem("EPSG:4326")
-            
-            for r in final_rows:
-                f = QgsFeature(layer.fields())
-                # geometry is the segment line
-                p1 = QgsPointXY(r['P1x'], r['P1y'])
-                p2 = QgsPointXY(r['P2x'], r['P2y'])
-                f.setGeometry(QgsGeometry.fromPolylineXY([p1, p2]))
-                # prepare WKT strings for Start/Stop POINTs
-
-                # --- Build WKT for start/stop points ---
-                if crs.isGeographic():
-                    # Already in lon/lat
-                    x1, y1 = p1.x(), p1.y()
-                    x2, y2 = p2.x(), p2.y()
+            # Projected CRS (e.g., UTM) → WGS84 transform, cached per CRS (custom CRSes have no authid)
+            transform = None
+            if not is_geographic:
+                if crs_authid:
+                    transform = _xform(crs_authid)
                 else:
-                    # Projected CRS (e.g., UTM) → transform to WGS84
+                    wgs84_crs = QgsCoordinateReferenceSystem("EPSG:4326")
                     transform = QgsCoordinateTransform(crs, wgs84_crs, QgsProject.instance())
-                    geo_p1 = transform.transform(p1)
-                    geo_p2 = transform.transform(p2)
-                    x1, y1 = geo_p1.x(), geo_p1.y()
-                    x2, y2 = geo_p2.x(), geo_p2.y()
-
-                # Format WKT with decimals
-                start_wkt = f"{y1:.4f}, {x1:.4f}"
-                stop_wkt  = f"{y2:.4f}, {x2:.4f}"
-
-                f.setAttributes([
-                    r.get('Line_ID', None),
-                    start_wkt,
-                    stop_wkt,
-                    r.get('length_m', None),
-                    r.get('length_nm', None),
-                    r.get('cum_length_m', None),
-                    r.get('cum_length_nm', None)
-                ])
-                feats.append(f)
-
-            pr.addFeatures(feats)
+
+            # segment endpoints in project CRS
+            P1 = np.round(self.P1[:n], 6)
+            P2 = np.round(self.P2[:n], 6)
+            start_pts = [QgsPointXY(x, y) for x, y in P1.tolist()]
+            stop_pts = [QgsPointXY(x, y) for x, y in P2.tolist()]
+
+            # --- Endpoints for start/stop WKT ---
+            if transform is None:
+                # Already in lon/lat
+                geo_start_pts, geo_stop_pts = start_pts, stop_pts
+            else:
+                # Projected CRS (e.g., UTM) → transform all endpoints to WGS84 in one call
+                endpoints = QgsGeometry.fromMultiPointXY(start_pts + stop_pts)
+                endpoints.transform(transform)
+                geo_pts = endpoints.asMultiPoint()
+                geo_start_pts = geo_pts[:len(start_pts)]
+                geo_stop_pts = geo_pts[len(start_pts):]
+
+            # Format WKT with decimals
+            start_wkts = [f"{p.y():.4f}, {p.x():.4f}" for p in geo_start_pts]
+            stop_wkts = [f"{p.y():.4f}, {p.x():.4f}" for p in geo_stop_pts]
+            attributes = [list(row) for row in zip(line_ids, start_wkts, stop_wkts,
+                                                   length_m, length_nm, cum_length_m, cum_length_nm)]
+
+            # add features
+            feats = [None] * n
+            segments = np.hstack((P1, P2)).tolist()
+            _Feat = QgsFeature
+            _Geom = QgsGeometry
+            _pack = _SEGMENT_WKB.pack
+            for i in range(n):
+                f = _Feat()
+                f.setFields(fields, False) # attributes are set as a whole below
+                # geometry is the segment line, built straight from WKB (1 = little endian, 2 = LineString)
+                g = _Geom()
+                g.fromWkb(_pack(1, 2, 2, *segments[i]))
+                f.setGeometry(g)
+                f.setAttributes(attributes[i])
+                feats[i] = f
+
+            pr.addFeatures(feats, QgsFeatureSink.FastInsert)
             layer.updateExtents()
 
             # add final layer to project
@@ -288,56 +399,42 @@ class AdvancedMeasureTool:
             # show attribute table (ONLY NOW)
             self.iface.showAttributeTable(layer)
 
-            # reset
-            self.table_rows = []
-            self.n = 0
-            self.point_id_counter = 0
-            self.var_cum_length_m = 0.0
-            self.click_count = 0
-            self.last_point = None
-            self.is_measuring = False
-
-            # remove drawing
-            self.main_rb.reset(QgsWkbTypes.LineGeometry)
+            # reset and remove drawing
+            self._reset_state()
 
         def keyPressEvent(self, event):
             # ESC to cancel measurement and remove any temporary artifacts
             if event.key() == Qt.Key_Escape:
-                
-                self.main_rb.reset(QgsWkbTypes.LineGeometry)
-                self.temp_rb.reset(QgsWkbTypes.LineGeometry)
+                self._reset_state()
                 self.iface.messageBar().pushMessage("AdvancedMeasureTool", "Measurement cancelled", level=Qgis.Info, duration=2)
 
 
         ###################################################################
         # SEGMENT CALCULATION
         ###################################################################
-        def _measure_length_dynamic(self, geom):
-            """Compute length using a fresh QgsDistanceArea object
-               to avoid CRS mismatch after CRS changes."""
-            da = QgsDistanceArea()
-            da.setSourceCrs(self.canvas.mapSettings().destinationCrs(),
-                            QgsProject.instance().transformContext())
-            da.setEllipsoid(QgsProject.instance().ellipsoid() or "WGS84")
-            return da.measureLength(geom)
- 
-        def calculate_segment(self, idx):
-            r = self.table_rows[idx]
-            p1 = QgsPointXY(r['P1x'], r['P1y'])
-            p2 = QgsPointXY(r['P2x'], r['P2y'])
-            geom = QgsGeometry.fromPolylineXY([p1, p2])
+        def _update_distance_area(self, *args):
+            """Point the distance calculator at the current canvas CRS and project ellipsoid."""
+            self.da.setSourceCrs(self.canvas.mapSettings().destinationCrs(),
+                                 QgsProject.instance().transformContext())
+            self.da.setEllipsoid(QgsProject.instance().ellipsoid() or 'WGS84')
+            crs = self.da.sourceCrs()
+            # projected CRS with metre map units and a transverse Mercator projection (e.g. UTM)
+            self._is_planar_meters = (not crs.isGeographic()
+                                      and crs.mapUnits() == QgsUnitTypes.DistanceMeters
+                                      and crs.projectionAcronym() in _PLANAR_PREVIEW_PROJECTIONS)
+            # geographic CRS with an ellipsoid: preview on the ellipsoid's mean sphere
+            self._is_lonlat = crs.isGeographic() and self.da.willUseEllipsoid()
+            self._sphere_radius = (2.0 * self.da.ellipsoidSemiMajor() + self.da.ellipsoidSemiMinor()) / 3.0
 
-            # Use dynamic distance calculator to stay CRS-safe
-            length_m = self._measure_length_dynamic(geom)
-            length_nm = length_m / 1852.0
+        def calculate_segment(self, idx):
+            p1 = QgsPointXY(*self.P1[idx])
+            p2 = QgsPointXY(*self.P2[idx])
 
-            self.var_cum_length_m += length_m
-            cum_nm = self.var_cum_length_m / 1852.0
+            length_m = self.da.measureLine(p1, p2)
+            self.length_m[idx] = length_m
 
-            r['length_m'] = round(length_m, 1)
-            r['length_nm'] = round(length_nm, 2)
-            r['cum_length_m'] = round(self.var_cum_length_m, 1)
-            r['cum_length_nm'] = round(cum_nm, 2)
+            # running total for the live preview; the stored cumulative columns come from np.cumsum
+            self._cum_at_last_vertex += length_m
 
 
 
@@ -345,12 +442,17 @@ class AdvancedMeasureTool:
         # START NEW
         ###################################################################
         def start_new_measurement(self):
+            self._reset_state()
             self.is_measuring = True
-            self.table_rows = []
-            self.n = 0
-            self.point_id_counter = 0
-            self.var_cum_length_m = 0.0
             self.click_count = 1
+
+        def _reset_state(self):
+            """Drop the current measurement: stored rows, running totals, drawing and preview message."""
+            self.n = 0
+            self._cum_at_last_vertex = 0.0
+            self.click_count = 0
             self.last_point = None
+            self.is_measuring = False
             self.main_rb.reset(QgsWkbTypes.LineGeometry)
             self.temp_rb.reset(QgsWkbTypes.LineGeometry)
+            self._clear_preview_message()